@@ -1,6 +1,12 @@
+import io
 import math
+from collections import defaultdict
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import streamlit as st
+from scipy.special import ndtr
 
 st.set_page_config(page_title="Longevity Quotient (LQ) v1.1 — Calculator", layout="wide")
 st.title("Longevity Quotient (LQ) v1.1 — Calculator")
@@ -43,6 +49,15 @@ VAR_ORDER = [
     "hrv","phq9","alt","egfr","bmd_t","truage_delta","small_hdl","rem_pct",
     "grip","swls","rpdqs"
 ]
+# z-normalized variables (everything but CAC and rPDQS), packed once into a contiguous
+# float64 table with one [M, S, D] row per variable, rows in VAR_ORDER_Z order
+VAR_ORDER_Z = [k for k in VAR_ORDER if k in REF]
+REF_TBL = np.array([[REF[k]["M"], REF[k]["S"], REF[k]["D"]] for k in VAR_ORDER_Z], dtype=np.float64)
+REF_M, REF_S, REF_D = np.ascontiguousarray(REF_TBL.T)
+REF_SCALE = REF_D / REF_S  # z = (x - M) * D/S: one multiply instead of a divide
+Z_IDX     = np.array([VAR_ORDER.index(k) for k in VAR_ORDER_Z])
+CAC_IDX   = VAR_ORDER.index("cac")
+RPDQS_IDX = VAR_ORDER.index("rpdqs")
 HELP = {
     "ogtt_2h":"2-hour OGTT (mg/dL)","apob":"ApoB (mg/dL)","vo2max":"VO₂max (mL/kg/min)",
     "crp":"CRP (mg/L)","bmi":"BMI","packyrs":"Pack-years","moca":"MoCA (0–30)",
@@ -52,63 +67,128 @@ HELP = {
     "rem_pct":"REM sleep (% TST)","grip":"Grip (kg)","swls":"SWLS (5–35)","rpdqs":"rPDQS (0–52)"
 }
 
-def normal_cdf(z: float) -> float:
-    return 0.5 * (1.0 + math.erf(z / math.sqrt(2.0)))
+LOG100 = math.log(100.0)  # CAC ln-method centre, hoisted out of normalize_cac
 
-def clamp(v, lo=0.0, hi=100.0):
-    return max(lo, min(hi, v))
+def normalize_rpdqs(values):
+    # scalar or array; 0–52 scale mapped to 0–100
+    return np.clip(np.asarray(values, dtype=np.float64) / 52.0 * 100.0, 0.0, 100.0)
 
-def normalize_z(x, key):
-    p = REF[key]; z = p["D"] * ((x - p["M"]) / p["S"])
-    return clamp(100.0 * normal_cdf(z))
-
-def normalize_rpdqs(x): return clamp((x/52.0)*100.0)
-
-def normalize_cac(value, method="ln"):
+def normalize_cac(values, method="ln"):
+    # scalar or array; piecewise map is branchless so a whole CAC column is one expression
+    v = np.asarray(values, dtype=np.float64)
     if method == "ln":
-        return clamp(100.0 * normal_cdf(-(math.log(value + 1.0) - math.log(100.0))))
+        return 100.0 * ndtr(LOG100 - np.log(v + 1.0))
     # piecewise
-    if value == 0: return 100.0
-    if value >= 400: return 0.0
-    if value <= 100: return clamp(100.0 - 0.2*value)
-    return clamp(50.0 - 0.1*(value - 100.0))
+    pw = np.select([v == 0, v >= 400, v <= 100], [100.0, 0.0, 100.0 - 0.2*v], 50.0 - 0.1*(v - 100.0))
+    return np.clip(pw, 0.0, 100.0)
+
+def _score_kernel(X, cac, rpdqs, cac_method="ln"):
+    # X: (n, len(VAR_ORDER_Z)) raw z-variables; cac, rpdqs: (n,) -> composite (n,), N (n, 20) in VAR_ORDER
+    # one (n, 20) buffer written by column index; per call, so concurrent sessions never share it
+    N_all = np.empty((X.shape[0], len(VAR_ORDER)), dtype=np.float64)
+    Z = np.subtract(X, REF_M)  # the only temporary; every later step runs in place
+    Z *= REF_SCALE
+    ndtr(Z, out=Z)
+    Z *= 100.0
+    N_all[:, Z_IDX]     = Z
+    N_all[:, CAC_IDX]   = normalize_cac(cac, cac_method)
+    N_all[:, RPDQS_IDX] = normalize_rpdqs(rpdqs)
+    return N_all.mean(axis=1), N_all
 
+@st.cache_data(max_entries=512)
 def compute_single(inputs: dict, cac_method="ln") -> dict:
-    N = {}
-    N["ogtt_2h"]      = normalize_z(inputs["ogtt_2h"], "ogtt_2h")
-    N["apob"]         = normalize_z(inputs["apob"], "apob")
-    N["vo2max"]       = normalize_z(inputs["vo2max"], "vo2max")
-    N["crp"]          = normalize_z(inputs["crp"], "crp")
-    N["bmi"]          = normalize_z(inputs["bmi"], "bmi")
-    N["packyrs"]      = normalize_z(inputs["packyrs"], "packyrs")
-    N["moca"]         = normalize_z(inputs["moca"], "moca")
-    N["mvpa"]         = normalize_z(inputs["mvpa"], "mvpa")
-    N["cac"]          = normalize_cac(inputs["cac"], cac_method)
-    N["hrv"]          = normalize_z(inputs["hrv"], "hrv")
-    N["phq9"]         = normalize_z(inputs["phq9"], "phq9")
-    N["alt"]          = normalize_z(inputs["alt"], "alt")
-    N["egfr"]         = normalize_z(inputs["egfr"], "egfr")
-    N["bmd_t"]        = normalize_z(inputs["bmd_t"], "bmd_t")
-    N["truage_delta"] = normalize_z(inputs["truage_delta"], "truage_delta")
-    N["small_hdl"]    = normalize_z(inputs["small_hdl"], "small_hdl")
-    N["rem_pct"]      = normalize_z(inputs["rem_pct"], "rem_pct")
-    N["grip"]         = normalize_z(inputs["grip"], "grip")
-    N["swls"]         = normalize_z(inputs["swls"], "swls")
-    N["rpdqs"]        = normalize_rpdqs(inputs["rpdqs"])
-    comp = sum(N[v] for v in VAR_ORDER) / 20.0
+    x = np.fromiter((inputs[k] for k in VAR_ORDER_Z), dtype=np.float64, count=len(VAR_ORDER_Z))
+    comp, N_all = _score_kernel(x[None, :], [inputs["cac"]], [inputs["rpdqs"]], cac_method)
+    comp = float(comp[0])
     LQ = max(300.0, min(850.0, 300.0 + 5.5*comp))
     out = {"composite": comp, "LQ": LQ}
-    out.update({f"N_{k}": v for k, v in N.items()})
+    out.update({f"N_{k}": v for k, v in zip(VAR_ORDER, N_all[0].tolist())})
     return out
 
+# odd 64-bit multipliers that fold a row's float64 bit patterns into one hashable uint64
+ROW_HASH = np.random.default_rng(0).integers(1, 2**63, len(VAR_ORDER), dtype=np.uint64) | np.uint64(1)
+
+def _unique_rows(X):
+    # -> (first index of each distinct row, row -> distinct-row codes), or None if nothing repeats
+    bits = X.view(np.uint64)
+    inverse, uniques = pd.factorize((bits * ROW_HASH).sum(axis=1))
+    if len(uniques) == len(inverse):
+        return None
+    _, first = np.unique(inverse, return_index=True)
+    if not (bits[first][inverse] == bits).all():  # hash collision; just score every row
+        return None
+    return first, inverse
+
+BULK_COLS = ["composite", "LQ"] + [f"N_{k}" for k in VAR_ORDER]
+
+def compute_bulk(df: pd.DataFrame, cac_method="ln") -> pd.DataFrame:
+    # score each distinct input row once, then broadcast back to the repeats
+    X = df[VAR_ORDER].to_numpy(dtype=np.float64)
+    uniq = _unique_rows(X)
+    U = X if uniq is None else X[uniq[0]]
+    comp, N_all = _score_kernel(U[:, Z_IDX], U[:, CAC_IDX], U[:, RPDQS_IDX], cac_method)
+    if uniq is not None:
+        comp, N_all = comp[uniq[1]], N_all[uniq[1]]
+    # results go into one float64 block that backs the frame directly; the whole bulk path
+    # is NumPy/SciPy ufunc calls on full columns (GIL released), with no per-row Python
+    res = np.empty((len(comp), len(BULK_COLS)), dtype=np.float64)
+    res[:, 0] = comp
+    np.clip(300.0 + 5.5*comp, 300.0, 850.0, out=res[:, 1])
+    res[:, 2:] = N_all
+    return pd.DataFrame(res, columns=BULK_COLS, index=df.index, copy=False)
+
+BULK_CHUNKSIZE = 50_000  # rows per read_csv chunk; bounds the scoring temporaries
+
+@st.cache_data(max_entries=8)
+def score_csv(data: bytes, cac_method="ln") -> pd.DataFrame:
+    # score columns are parsed straight to float64 by the C parser (no type inference); every
+    # other column is kept as text, so IDs stay identical across chunks (leading zeros too)
+    dtypes = defaultdict(lambda: str, dict.fromkeys(VAR_ORDER, np.float64))
+    reader = pd.read_csv(io.BytesIO(data), dtype=dtypes, chunksize=BULK_CHUNKSIZE)
+    out_frames = []
+    for chunk in reader:
+        missing = [k for k in VAR_ORDER if k not in chunk.columns]
+        if missing:
+            raise ValueError("Missing columns: " + ", ".join(missing))
+        clashing = [k for k in BULK_COLS if k in chunk.columns]
+        if clashing:
+            raise ValueError("Input already has result columns: " + ", ".join(clashing))
+        out_frames.append(pd.concat([chunk, compute_bulk(chunk, cac_method=cac_method)], axis=1))
+    return pd.concat(out_frames, ignore_index=True)
+
+@st.cache_data(max_entries=8)
+def score_csv_download(data: bytes, cac_method="ln") -> bytes:
+    # Arrow's vectorized CSV writer; DataFrame.to_csv formats every cell in Python
+    out_df = score_csv(data, cac_method=cac_method)
+    # Arrow needs one type per column; pass-through text columns go over as strings (nulls kept)
+    out_df = out_df.astype({c: "string" for c in out_df.select_dtypes(include="object").columns})
+    buf = io.BytesIO()
+    pacsv.write_csv(pa.Table.from_pandas(out_df, preserve_index=False), buf)
+    return buf.getvalue()
+
+# Single-patient input bounds and step: (min, max, step); None = unbounded
+INPUT_BOUNDS = {
+    "ogtt_2h": (0.0, None, 1.0), "apob": (0.0, None, 1.0), "vo2max": (0.0, None, 0.1),
+    "crp": (0.0, None, 0.1), "bmi": (0.0, None, 0.1), "packyrs": (0.0, None, 0.1),
+    "moca": (0.0, 30.0, 0.5), "mvpa": (0.0, None, 1.0), "cac": (0.0, None, 1.0),
+    "hrv": (0.0, None, 1.0), "phq9": (0.0, 27.0, 1.0), "alt": (0.0, None, 1.0),
+    "egfr": (0.0, None, 1.0), "bmd_t": (None, None, 0.1), "truage_delta": (None, None, 0.1),
+    "small_hdl": (0.0, None, 0.1), "rem_pct": (0.0, 100.0, 0.1), "grip": (0.0, None, 0.1),
+    "swls": (0.0, 35.0, 1.0), "rpdqs": (0.0, 52.0, 1.0),
+}
+
+# Built once at import; the widgets only read them, so callers share these dicts
+PREFILLS = {
+    "high": dict(ogtt_2h=85,apob=60,vo2max=55,crp=0.4,bmi=22.5,packyrs=0,moca=29,mvpa=300,
+                 cac=0,hrv=75,phq9=0,alt=18,egfr=110,bmd_t=1.0,truage_delta=-5,small_hdl=40,
+                 rem_pct=(120/420)*100,grip=55,swls=33,rpdqs=48),
+    "typical": dict(ogtt_2h=152,apob=107,vo2max=34,crp=2,bmi=29.6,packyrs=0,moca=25,mvpa=112.5,
+                    cac=98,hrv=47,phq9=7,alt=42,egfr=82,bmd_t=-1.2,truage_delta=2,small_hdl=10.2,
+                    rem_pct=(52/420)*100,grip=38,swls=26,rpdqs=35),
+}
+
 def prefill(which="typical"):
-    if which=="high":
-        return dict(ogtt_2h=85,apob=60,vo2max=55,crp=0.4,bmi=22.5,packyrs=0,moca=29,mvpa=300,
-                    cac=0,hrv=75,phq9=0,alt=18,egfr=110,bmd_t=1.0,truage_delta=-5,small_hdl=40,
-                    rem_pct=(120/420)*100,grip=55,swls=33,rpdqs=48)
-    return dict(ogtt_2h=152,apob=107,vo2max=34,crp=2,bmi=29.6,packyrs=0,moca=25,mvpa=112.5,
-                cac=98,hrv=47,phq9=7,alt=42,egfr=82,bmd_t=-1.2,truage_delta=2,small_hdl=10.2,
-                rem_pct=(52/420)*100,grip=38,swls=26,rpdqs=35)
+    return PREFILLS["high"] if which=="high" else PREFILLS["typical"]
 
 st.sidebar.header("Settings")
 cac_method = st.sidebar.selectbox("CAC method", options=["ln","piecewise"], index=0)
@@ -123,68 +203,54 @@ if mode == "Single patient":
         st.session_state.pref = prefill("typical")
     if cpb.button("Prefill: High Performer"):
         st.session_state.pref = prefill("high")
-    defaults = st.session_state.get("pref", prefill("typical"))
+    defaults = st.session_state.get("pref") or prefill("typical")
 
     use_oura = st.checkbox("Compute MVPA from Oura High/Medium", value=False)
     use_rem  = st.checkbox("Compute REM% from minutes + TST", value=False)
 
-    colA, colB, colC, colD = st.columns(4)
-
-    # MVPA helper
-    if use_oura:
-        oh = st.number_input("Oura High (min/wk)", min_value=0.0, value=100.0, step=1.0, key="oh")
-        om = st.number_input("Oura Medium (min/wk)", min_value=0.0, value=100.0, step=1.0, key="om")
-        mvpa_val = min(1000.0, oh + 0.5*om)
-        st.info(f"Computed MVPA = {mvpa_val:.1f}")
-    else:
-        mvpa_val = st.number_input(HELP["mvpa"], min_value=0.0, value=float(defaults["mvpa"]), step=1.0, key="mvpa")
-
-    # REM helper
-    if use_rem:
-        rem_m = st.number_input("REM minutes", min_value=0.0, value=52.0, step=1.0, key="rem_m")
-        tst_m = st.number_input("Total Sleep Time (minutes)", min_value=1.0, value=420.0, step=1.0, key="tst_m")
-        rem_pct_val = 100.0 * rem_m / tst_m
-        st.info(f"Computed REM% = {rem_pct_val:.1f}%")
-    else:
-        rem_pct_val = st.number_input(HELP["rem_pct"], min_value=0.0, max_value=100.0,
-                                      value=float(defaults["rem_pct"]), step=0.1, key="rem_pct")
-
-    with colA:
-        ogtt_2h = st.number_input(HELP["ogtt_2h"], min_value=0.0, value=float(defaults["ogtt_2h"]), step=1.0, key="ogtt_2h")
-        apob    = st.number_input(HELP["apob"],    min_value=0.0, value=float(defaults["apob"]),    step=1.0, key="apob")
-        vo2max  = st.number_input(HELP["vo2max"],  min_value=0.0, value=float(defaults["vo2max"]),  step=0.1, key="vo2max")
-        crp     = st.number_input(HELP["crp"],     min_value=0.0, value=float(defaults["crp"]),     step=0.1, key="crp")
-        bmi     = st.number_input(HELP["bmi"],     min_value=0.0, value=float(defaults["bmi"]),     step=0.1, key="bmi")
-
-    with colB:
-        packyrs = st.number_input(HELP["packyrs"], min_value=0.0, value=float(defaults["packyrs"]), step=0.1, key="packyrs")
-        moca    = st.number_input(HELP["moca"],    min_value=0.0, max_value=30.0, value=float(defaults["moca"]), step=0.5, key="moca")
-        cac     = st.number_input(HELP["cac"],     min_value=0.0, value=float(defaults["cac"]),     step=1.0, key="cac")
-        hrv     = st.number_input(HELP["hrv"],     min_value=0.0, value=float(defaults["hrv"]),     step=1.0, key="hrv")
-        phq9    = st.number_input(HELP["phq9"],    min_value=0.0, max_value=27.0, value=float(defaults["phq9"]), step=1.0, key="phq9")
-
-    with colC:
-        alt     = st.number_input(HELP["alt"],     min_value=0.0, value=float(defaults["alt"]),     step=1.0, key="alt")
-        egfr    = st.number_input(HELP["egfr"],    min_value=0.0, value=float(defaults["egfr"]),    step=1.0, key="egfr")
-        bmd_t   = st.number_input(HELP["bmd_t"],                         value=float(defaults["bmd_t"]),   step=0.1, key="bmd_t")
-        truage_delta = st.number_input(HELP["truage_delta"],             value=float(defaults["truage_delta"]), step=0.1, key="truage_delta")
-        small_hdl    = st.number_input(HELP["small_hdl"], min_value=0.0, value=float(defaults["small_hdl"]),  step=0.1, key="small_hdl")
-
-    with colD:
-        grip  = st.number_input(HELP["grip"],  min_value=0.0, value=float(defaults["grip"]),  step=0.1, key="grip")
-        swls  = st.number_input(HELP["swls"],  min_value=0.0, max_value=35.0, value=float(defaults["swls"]), step=1.0, key="swls")
-        rpdqs = st.number_input(HELP["rpdqs"], min_value=0.0, max_value=52.0, value=float(defaults["rpdqs"]), step=1.0, key="rpdqs")
-
-    st.divider()
-    compute = st.button("Compute LQ", type="primary")
+    # Inputs sit in a form so editing them doesn't rerun the script; one rerun per submit
+    with st.form("lq_inputs"):
+        # MVPA helper
+        if use_oura:
+            oh = st.number_input("Oura High (min/wk)", min_value=0.0, value=100.0, step=1.0, key="oh")
+            om = st.number_input("Oura Medium (min/wk)", min_value=0.0, value=100.0, step=1.0, key="om")
+            mvpa_val = min(1000.0, oh + 0.5*om)
+            st.info(f"Computed MVPA = {mvpa_val:.1f}")
 
-    if compute:
-        raw = dict(
-            ogtt_2h=ogtt_2h, apob=apob, vo2max=vo2max, crp=crp, bmi=bmi,
-            packyrs=packyrs, moca=moca, mvpa=mvpa_val, cac=cac, hrv=hrv,
-            phq9=phq9, alt=alt, egfr=egfr, bmd_t=bmd_t, truage_delta=truage_delta,
-            small_hdl=small_hdl, rem_pct=rem_pct_val, grip=grip, swls=swls, rpdqs=rpdqs
+        # REM helper
+        if use_rem:
+            rem_m = st.number_input("REM minutes", min_value=0.0, value=52.0, step=1.0, key="rem_m")
+            tst_m = st.number_input("Total Sleep Time (minutes)", min_value=1.0, value=420.0, step=1.0, key="tst_m")
+            rem_pct_val = 100.0 * rem_m / tst_m
+            st.info(f"Computed REM% = {rem_pct_val:.1f}%")
+
+        # One-row editor instead of 20 number_inputs: one widget and one state diff per edit.
+        # Variables supplied by a helper above are left out of the grid.
+        grid_vars = [k for k in VAR_ORDER
+                     if not (k == "mvpa" and use_oura) and not (k == "rem_pct" and use_rem)]
+        edited = st.data_editor(
+            pd.DataFrame([defaults])[grid_vars].astype(np.float64),
+            num_rows="fixed", hide_index=True, use_container_width=True,
+            column_config={k: st.column_config.NumberColumn(HELP[k], min_value=INPUT_BOUNDS[k][0],
+                                                            max_value=INPUT_BOUNDS[k][1],
+                                                            step=INPUT_BOUNDS[k][2], required=True)
+                           for k in grid_vars},
         )
+
+        st.divider()
+        compute = st.form_submit_button("Compute LQ", type="primary")
+
+    if compute:
+        raw = edited.iloc[0].to_dict()
+        if use_oura:
+            raw["mvpa"] = mvpa_val
+        if use_rem:
+            raw["rem_pct"] = rem_pct_val
+        raw = {k: raw[k] for k in VAR_ORDER}
+        blank = [HELP[k] for k in VAR_ORDER if pd.isna(raw[k])]
+        if blank:
+            st.error("Missing values: " + ", ".join(blank))
+            st.stop()
         res = compute_single(raw, cac_method=cac_method)
         c1, c2 = st.columns(2)
         c1.metric("Composite (0–100)", f"{res['composite']:.2f}")
@@ -202,3 +268,21 @@ if mode == "Single patient":
         st.download_button("Download results (CSV)",
                            out_df.to_csv(index=False).encode("utf-8"),
                            file_name="lq_single_result.csv", mime="text/csv")
+
+else:
+    st.subheader("Bulk CSV")
+    st.caption("Upload a CSV with one row per patient and columns: " + ", ".join(VAR_ORDER))
+    upload = st.file_uploader("CSV file", type=["csv"])
+
+    if upload is not None:
+        data = upload.getvalue()
+        try:
+            out_df = score_csv(data, cac_method=cac_method)
+            out_csv = score_csv_download(data, cac_method=cac_method)
+        except (ValueError, pa.ArrowException) as e:
+            st.error(str(e))
+        else:
+            st.success(f"Scored {len(out_df)} rows")
+            st.dataframe(out_df, use_container_width=True)
+            st.download_button("Download results (CSV)", out_csv,
+                               file_name="lq_bulk_results.csv", mime="text/csv")